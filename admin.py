@@ -1,10 +1,13 @@
 import streamlit as st
 import os
 import tempfile
-import json
-from moviepy import VideoFileClip
+import shutil
+import uuid
+import httpx
 from openai import OpenAI
-from supabase import create_client, Client
+from supabase import create_client
+from pydantic import BaseModel
+from common import TMPDIR, STORAGE_TIMEOUT, Question, storage_filename, get_duration, extract_audio, upload_video, truncate_transcript
 
 
 st.set_page_config(page_title="Fluency Admin", page_icon="🧠")
@@ -34,117 +37,123 @@ SUPABASE_URL = st.secrets["SUPABASE_URL"]
 SUPABASE_KEY = st.secrets["SUPABASE_KEY"]
 OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
 
-# Initialize Clients
+# Initialize Clients (cached, so a rerun on every click doesn't rebuild them and redo TLS setup)
+@st.cache_resource
+def get_clients():
+    return (
+        create_client(SUPABASE_URL, SUPABASE_KEY),
+        OpenAI(api_key=OPENAI_API_KEY),
+        httpx.Client(timeout=STORAGE_TIMEOUT)
+    )
+
 try:
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-    client = OpenAI(api_key=OPENAI_API_KEY)
+    supabase, client, http = get_clients()
     st.sidebar.success("✅ Connected to Cloud")
 except Exception as e:
     st.sidebar.error(f"❌ Connection Failed: {e}")
 
+# --- AI OUTPUT MODEL (enforced via structured outputs) ---
+class Coursework(BaseModel):
+    questions: list[Question]
+
 # --- HELPER FUNCTIONS ---
+def publish_video(video_path, file_name):
+    upload_video(http, SUPABASE_URL, SUPABASE_KEY, video_path, file_name)
+    return supabase.storage.from_("videos").get_public_url(file_name)
+
 def process_video(uploaded_file, title, category, sub_category):
-    # 1. Save to Temp File (MoviePy needs a real file path)
-    tfile = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") 
-    tfile.write(uploaded_file.read())
-    temp_video_path = tfile.name
-    
-    status_text.text("⏳ Extracting Audio...")
-    progress_bar.progress(10)
-    
-    # 2. Extract Audio
-    audio_path = "temp_audio.mp3"
-    try:
-        video = VideoFileClip(temp_video_path)
-        video.audio.write_audiofile(audio_path, logger=None)
-        duration = video.duration
-        video.close()
-    except Exception as e:
-        st.error(f"Error processing video: {e}")
-        return
-
-    # 3. Transcribe
-    status_text.text("🎙️ Transcribing with Whisper...")
-    progress_bar.progress(30)
-    
-    with open(audio_path, "rb") as audio_file:
-        transcript = client.audio.transcriptions.create(
-            model="whisper-1", 
-            file=audio_file
-        )
-    transcript_text = transcript.text
-    
-    # 4. Upload to Supabase Storage
-    status_text.text("☁️ Uploading Video to Cloud...")
-    progress_bar.progress(50)
-    
-    file_name = f"{title.replace(' ', '_')}.mp4"
-    with open(temp_video_path, 'rb') as f:
-        supabase.storage.from_("videos").upload(
-            path=file_name,
-            file=f,
-            file_options={"content-type": "video/mp4", "x-upsert": "true"}
+    # Temp files live in a per-run dir that is removed even if a step fails midway
+    with tempfile.TemporaryDirectory(dir=TMPDIR) as work_dir:
+        # 1. Save to Temp File (ffmpeg needs a real file path)
+        # Copy in 8MB chunks rather than holding the whole upload in memory
+        temp_video_path = os.path.join(work_dir, "upload.mp4")
+        with open(temp_video_path, "wb") as tfile:
+            shutil.copyfileobj(uploaded_file, tfile, length=8 * 1024 * 1024)
+    
+        status_text.text("⏳ Extracting Audio...")
+        progress_bar.progress(10)
+    
+        # 2. Extract Audio
+        audio_path = os.path.splitext(temp_video_path)[0] + ".ogg"
+        try:
+            duration = get_duration(temp_video_path)
+            extract_audio(temp_video_path, audio_path)
+        except Exception as e:
+            st.error(f"Error processing video: {e}")
+            return
+
+        # 3. Transcribe
+        status_text.text("🎙️ Transcribing with Whisper...")
+        progress_bar.progress(30)
+    
+        with open(audio_path, "rb") as audio_file:
+            # Plain-text response: we only need the text, not the JSON envelope
+            transcript_text = client.audio.transcriptions.create(
+                model="whisper-1", 
+                file=audio_file,
+                response_format="text",
+                temperature=0
+            )
+    
+        # 4. Upload to Supabase Storage
+        status_text.text("☁️ Uploading Video to Cloud...")
+        progress_bar.progress(50)
+    
+        file_name = storage_filename(title, uuid.uuid4().hex[:8])
+        public_url = publish_video(temp_video_path, file_name)
+
+        # 5. Generate Questions (AI)
+        status_text.text("🧠 Generating Coursework...")
+        progress_bar.progress(70)
+    
+        prompt = f"""
+        Analyze the following transcript. Generate 5 Multiple Choice Questions (Stages 0-4).
+        CRITICAL RULES: Difficulty HARD. Three wrong options per question.
+    
+        TRANSCRIPT: {truncate_transcript(transcript_text)}
+        """
+    
+        response = client.chat.completions.parse(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": prompt}
+            ],
+            response_format=Coursework
         )
-    
-    public_url = supabase.storage.from_("videos").get_public_url(file_name)
-
-    # 5. Generate Questions (AI)
-    status_text.text("🧠 Generating Coursework...")
-    progress_bar.progress(70)
-    
-    prompt = f"""
-    Analyze the following transcript. Generate 5 Multiple Choice Questions (Stages 0-4).
-    CRITICAL RULES: Difficulty HARD. JSON Output.
-    Format: {{ "questions": [ {{ "stage": 0, "q": "...", "correct": "...", "wrong": [...] }} ] }}
-    
-    TRANSCRIPT: {transcript_text[:15000]}
-    """
-    
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant that outputs JSON."},
-            {"role": "user", "content": prompt}
-        ],
-        response_format={ "type": "json_object" }
-    )
-    questions_json = json.loads(response.choices[0].message.content)
-    
-    # 6. Save to Database
-    status_text.text("💾 Saving to Database...")
-    progress_bar.progress(90)
-    
-    full_category = f"{category} > {sub_category}" if sub_category else category
-    
-    video_data = {
-        "video_url": public_url,
-        "title": title,
-        "transcript_text": transcript_text,
-        "category": full_category,
-        "duration_seconds": int(duration)
-    }
-    
-    data = supabase.table("content_library").insert(video_data).execute()
-    new_video_id = data.data[0]['id']
-    
-    q_inserts = []
-    for item in questions_json['questions']:
-        q_inserts.append({
-            "video_id": new_video_id,
-            "difficulty_phase": item['stage'],
-            "question_text": item['q'],
-            "correct_answer": item['correct'],
-            "wrong_options": item['wrong']
-        })
-    supabase.table("questions").insert(q_inserts).execute()
-    
-    # Cleanup
-    os.remove(temp_video_path)
-    os.remove(audio_path)
-    
-    progress_bar.progress(100)
-    status_text.text("✅ DONE!")
-    st.balloons()
+        coursework = response.choices[0].message.parsed
+        if coursework is None:
+            st.error(f"AI refused to generate questions: {response.choices[0].message.refusal}")
+            return
+    
+        # 6. Save to Database
+        status_text.text("💾 Saving to Database...")
+        progress_bar.progress(90)
+    
+        full_category = f"{category} > {sub_category}" if sub_category else category
+    
+        video_data = {
+            "video_url": public_url,
+            "title": title,
+            "transcript_text": transcript_text,
+            "category": full_category,
+            "duration_seconds": int(duration)
+        }
+    
+        q_inserts = []
+        for item in coursework.questions:
+            q_inserts.append({
+                "difficulty_phase": item.stage,
+                "question_text": item.q,
+                "correct_answer": item.correct,
+                "wrong_options": item.wrong
+            })
+        # One round-trip: the video row and its questions are inserted in a single transaction
+        supabase.rpc("create_video_with_questions", {"vid_data": video_data, "q_data": q_inserts}).execute()
+    
+        progress_bar.progress(100)
+        status_text.text("✅ DONE!")
+        st.balloons()
 
 # --- UI LAYOUT ---
 st.set_page_config(page_title="Fluency Admin", page_icon="🧠")
@@ -177,4 +186,5 @@ elif submitted:
 
 # Preview Section
 if uploaded_file:
+    uploaded_file.seek(0) # process_video may have consumed it
     st.video(uploaded_file)
\ No newline at end of file
@@ -1,12 +1,27 @@
 import os
+import re
 import json
+import asyncio
+import threading
+import functools
+import subprocess
+import tempfile
+import glob
+import httpx
 import uvicorn
 from fastapi import FastAPI, BackgroundTasks, HTTPException
-from pydantic import BaseModel
-from moviepy import VideoFileClip
-from openai import OpenAI
+from pydantic import BaseModel, Field
+import openai
+from openai import OpenAI, DefaultHttpxClient
+from tenacity import retry, stop_after_attempt, wait_exponential_jitter, retry_if_exception_type
 from supabase import create_client, Client
+from redis import Redis
+from rq import Queue
 import yt_dlp
+from common import (
+    TMPDIR, STORAGE_TIMEOUT, AUDIO_FILTERS, AUDIO_ENCODE, Question,
+    storage_filename, get_duration, extract_audio, upload_video, truncate_transcript
+)
 
 # --- CONFIG ---
 app = FastAPI()
@@ -15,23 +30,85 @@ app = FastAPI()
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+REDIS_URL = os.getenv("REDIS_URL")
+# Only download + upload the MP4 when we host playback ourselves; otherwise link to the source URL
+HOST_VIDEOS = os.getenv("HOST_VIDEOS") == "1"
+# Audio longer than this is split and sent to Whisper as parallel requests
+WHISPER_CHUNK_SECONDS = 600
 
 if not SUPABASE_URL:
     raise ValueError("❌ Missing SUPABASE_URL environment variable")
     
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Shared keep-alive pools, sized for concurrent chunk transcriptions and uploads
+HTTP_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=20)
+http = httpx.Client(limits=HTTP_LIMITS, timeout=STORAGE_TIMEOUT)
+# Retries are handled by openai_retry below, so the SDK's own retry loop is turned off
+client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0, http_client=DefaultHttpxClient(limits=HTTP_LIMITS))
+
+# OpenAI limits: cap in-flight requests and back off (with jitter) on 429/5xx/network errors.
+# The cap is per process (a thread semaphore, so it works across the event loops each RQ job
+# creates); across workers, the account limit is handled by the backoff alone.
+OPENAI_SLOTS = threading.BoundedSemaphore(int(os.getenv("OPENAI_CONCURRENCY", "4")))
+openai_retry = retry(
+    stop=stop_after_attempt(6),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception_type((openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)),
+    reraise=True
+)
+
+# Job queue: with REDIS_URL set, /capture enqueues and `rq worker -w rq.SimpleWorker --url $REDIS_URL`
+# runs the pipeline (the Procfile `worker` process; it must be deployed alongside the web service).
+# SimpleWorker keeps api.py imported between jobs; the default forking worker would re-import it per job.
+# Without it (local dev), jobs fall back to in-process BackgroundTasks.
+queue = Queue(connection=Redis.from_url(REDIS_URL)) if REDIS_URL else None
+
+# Optional self-hosted Whisper (GPU): set USE_LOCAL_WHISPER=1 and `pip install faster-whisper`
+USE_LOCAL_WHISPER = os.getenv("USE_LOCAL_WHISPER") == "1"
+# functools.cache doesn't block concurrent first calls; without this, simultaneous
+# BackgroundTasks jobs would each load their own copy of the model
+_whisper_lock = threading.Lock()
+
+def get_local_whisper():
+    with _whisper_lock:
+        return _load_local_whisper()
+
+@functools.cache
+def _load_local_whisper():
+    # Loaded on first use, so the web process (which only enqueues) never holds the model.
+    # Workers run as rq.SimpleWorker (see Procfile), so it stays warm across jobs.
+    import ctranslate2
+    from faster_whisper import WhisperModel, BatchedInferencePipeline
+    # int8 weights halve memory vs FP16: int8_float16 on GPU, plain int8 (VNNI) on CPU.
+    # A pre-quantized model dir also works here, e.g.
+    # `ct2-transformers-converter --model openai/whisper-large-v3 --quantization int8_float16`
+    if ctranslate2.get_cuda_device_count() > 0:
+        whisper_model = WhisperModel("large-v3", device="cuda", compute_type="int8_float16")
+    else:
+        whisper_model = WhisperModel("large-v3", device="cpu", compute_type="int8")
+    return BatchedInferencePipeline(whisper_model)
 
 # --- REQUEST MODEL ---
 class VideoRequest(BaseModel):
     url: str
 
+# --- AI OUTPUT MODEL (enforced via structured outputs) ---
+class Metadata(BaseModel):
+    title: str = Field(description="Short Descriptive Title")
+    speaker: str = Field(description="Name or Unknown")
+    category: str = Field(description="Broad Category (e.g. Psychology)")
+    sub_category: str | None = Field(description="Specific Niche (e.g. Behavior)")
+
+class Analysis(BaseModel):
+    metadata: Metadata
+    questions: list[Question]
+
 # --- HELPER: DOWNLOADER ---
-def download_video(url):
-    print(f"🔗 Downloading: {url}")
+def download_audio(url, out_dir):
+    print(f"🔗 Downloading audio: {url}")
     ydl_opts = {
-        'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
-        'outtmpl': 'temp_%(id)s.%(ext)s',
+        'format': 'bestaudio[ext=m4a]/bestaudio',
+        'outtmpl': os.path.join(out_dir, 'audio_%(id)s.%(ext)s'),
         'noplaylist': True,
         'quiet': True
     }
@@ -39,163 +116,283 @@ def download_video(url):
         info = ydl.extract_info(url, download=True)
         return ydl.prepare_filename(info), info.get('title', 'Unknown')
 
-# --- HELPER: THE PIPELINE (REVISED) ---
-def run_pipeline(url: str):
-    if not url or url == "":
-        print("❌ Received empty URL. Aborting.")
-        return
+def download_and_split(url, out_dir):
+    # Single pass for hosted videos: yt-dlp streams to stdout and ffmpeg writes the
+    # MP4 (stream copy) and the Whisper audio at the same time, while the download is still running
+    print(f"🔗 Downloading video: {url}")
+    with yt_dlp.YoutubeDL({'noplaylist': True, 'quiet': True}) as ydl:
+        info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+    video_path = os.path.join(out_dir, f"video_{info['id']}.mp4")
+    audio_path = os.path.join(out_dir, f"audio_{info['id']}.ogg")
+    # Hand the same metadata to the CLI so the pipe downloads exactly the id/title used here
+    info_path = os.path.join(out_dir, f"info_{info['id']}.json")
+    with open(info_path, "w") as f:
+        json.dump(info, f)
 
-    print(f"🚀 Pipeline Started for: {url}")
-    
-    # 1. Download
+    ytdlp = subprocess.Popen([
+        "yt-dlp", "-q",
+        "-f", "bv*[height<=720][ext=mp4]+ba[ext=m4a]/b[height<=720]/b",
+        "--load-info-json", info_path, "-o", "-"
+    ], stdout=subprocess.PIPE)
     try:
-        video_path, source_title = download_video(url)
-    except Exception as e:
-        print(f"❌ Download failed: {e}")
-        return
+        ffmpeg = subprocess.run([
+            "ffmpeg", "-y", "-v", "error", "-i", "pipe:0",
+            "-map", "0:v:0", "-map", "0:a:0", "-c", "copy", video_path,
+            "-map", "0:a:0", "-af", AUDIO_FILTERS, *AUDIO_ENCODE, audio_path
+        ], stdin=ytdlp.stdout)
+    except BaseException:
+        ytdlp.kill()
+        raise
+    finally:
+        ytdlp.stdout.close()
+        ytdlp.wait()
+    if ytdlp.returncode != 0 or ffmpeg.returncode != 0:
+        raise RuntimeError(f"yt-dlp | ffmpeg failed (exit {ytdlp.returncode} / {ffmpeg.returncode})")
+    return video_path, audio_path, info.get('title', 'Unknown'), info['id']
 
-    # 2. Extract Audio
-    print("🔊 Extracting Audio...")
-    audio_path = video_path.replace(".mp4", ".mp3")
-    try:
-        video = VideoFileClip(video_path)
-        if video.duration < 5:
-            print("❌ Video too short (likely a download error/captcha). Aborting.")
-            video.close()
-            return
-        video.audio.write_audiofile(audio_path, logger=None)
-        duration = video.duration
-        video.close()
-    except Exception as e:
-        print(f"❌ Audio Error: {e}")
-        return
+# --- HELPER: TRANSCRIBE ---
+def transcribe_local(audio_path):
+    # VAD-splits the audio into <30s chunks and batches them through the GPU
+    segments, info = get_local_whisper().transcribe(audio_path, batch_size=16)
+    return " ".join(segment.text.strip() for segment in segments)
 
-    # 3. Transcribe
-    print("🎙️ Transcribing...")
-    with open(audio_path, "rb") as f:
-        transcript = client.audio.transcriptions.create(model="whisper-1", file=f)
-    transcript_text = transcript.text
+@openai_retry
+def transcribe_file(audio_path):
+    # Plain-text response: we only need the text, not the JSON envelope
+    with OPENAI_SLOTS, open(audio_path, "rb") as f:
+        return client.audio.transcriptions.create(
+            model="whisper-1", file=f, response_format="text", temperature=0
+        )
 
-    if len(transcript_text) < 20:
-        print(f"❌ Transcript too short ('{transcript_text}'). Aborting.")
-        return
+def find_cut_points(audio_path, duration):
+    # Cut at a pause near each WHISPER_CHUNK_SECONDS mark so no word straddles two chunks.
+    # extract_audio shortens pauses to ~0.7s rather than removing them, so silencedetect still finds them.
+    log = subprocess.run([
+        "ffmpeg", "-hide_banner", "-nostats", "-i", audio_path,
+        "-af", "silencedetect=noise=-40dB:d=0.15", "-f", "null", "-"
+    ], capture_output=True, text=True, check=True).stderr
+    starts = re.findall(r"silence_start: ([\d.]+)", log)
+    ends = re.findall(r"silence_end: ([\d.]+)", log)
+    pauses = [(float(a) + float(b)) / 2 for a, b in zip(starts, ends)]
 
-    # 4. AI Analysis
-    print("🧠 AI Analyzing...")
-    
-    # STRONGER PROMPT
-    prompt = f"""
-    Analyze this transcript. Output Valid JSON.
-    
-    REQUIRED JSON STRUCTURE:
-    {{
-      "metadata": {{
-        "title": "Short Descriptive Title",
-        "speaker": "Name or Unknown",
-        "category": "Broad Category (e.g. Psychology)",
-        "sub_category": "Specific Niche (e.g. Behavior)"
-      }},
-      "questions": [
-        {{
-          "stage": 0,
-          "q": "Question text?",
-          "correct": "Correct Answer",
-          "wrong": ["Wrong1", "Wrong2", "Wrong3"]
-        }}
-      ]
-    }}
-    
-    TRANSCRIPT: {transcript_text[:15000]}
-    """
-    
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
+    cuts = []
+    mark = WHISPER_CHUNK_SECONDS
+    while mark < duration:
+        # Latest pause in the minute before the mark; hard cut at the mark if there is none
+        near = [t for t in pauses if mark - 60 <= t <= mark]
+        cut = max(near) if near else mark
+        cuts.append(cut)
+        mark = cut + WHISPER_CHUNK_SECONDS
+    return cuts
+
+def split_audio(audio_path, out_dir, cuts):
+    # Stream copy: cuts on packet boundaries without re-encoding; each chunk restarts at t=0
+    subprocess.run([
+        "ffmpeg", "-y", "-v", "error", "-i", audio_path,
+        "-f", "segment", "-segment_times", ",".join(f"{c:.3f}" for c in cuts),
+        "-reset_timestamps", "1", "-c", "copy",
+        os.path.join(out_dir, "chunk_%03d.ogg")
+    ], check=True)
+    return sorted(glob.glob(os.path.join(out_dir, "chunk_*.ogg")))
+
+async def transcribe(audio_path):
+    if USE_LOCAL_WHISPER:
+        return await asyncio.to_thread(transcribe_local, audio_path)
+
+    duration = await asyncio.to_thread(get_duration, audio_path)
+    if duration <= WHISPER_CHUNK_SECONDS:
+        return await asyncio.to_thread(transcribe_file, audio_path)
+
+    # Long audio: chunks are independent, so wall time is roughly the slowest chunk
+    cuts = await asyncio.to_thread(find_cut_points, audio_path, duration)
+    with tempfile.TemporaryDirectory(dir=TMPDIR) as chunk_dir:
+        chunks = await asyncio.to_thread(split_audio, audio_path, chunk_dir, cuts)
+        texts = await asyncio.gather(*(asyncio.to_thread(transcribe_file, c) for c in chunks))
+    return " ".join(text.strip() for text in texts)
+
+# --- HELPER: PROMPT ---
+@openai_retry
+def analyze(prompt):
+    with OPENAI_SLOTS:
+        return client.chat.completions.parse(
+            model="gpt-4o-mini",
             messages=[
-                {"role": "system", "content": "You are a database entry bot. Output ONLY valid JSON."}, 
+                {"role": "system", "content": "You are a database entry bot."},
                 {"role": "user", "content": prompt}
             ],
-            response_format={ "type": "json_object" }
+            response_format=Analysis
         )
-        
-        # DEBUG: Print the raw AI response so we can see if it fails
-        raw_content = response.choices[0].message.content
-        print(f"🔍 AI RAW OUTPUT: {raw_content[:100]}...") 
-        
-        ai_data = json.loads(raw_content)
-        meta = ai_data.get('metadata', {})
-        questions = ai_data.get('questions', [])
-        
-    except Exception as e:
-        print(f"❌ AI JSON Error: {e}")
-        return
 
-    # 5. Upload Video
-    print("☁️ Uploading...")
-    # Safe filename
-    safe_title = "".join(x for x in meta.get('title', 'Video') if x.isalnum() or x in " _-")
-    filename = f"{safe_title.replace(' ', '_')}.mp4"
-    
+# --- HELPER: STORAGE ---
+def publish_video(video_path, filename):
+    upload_video(http, SUPABASE_URL, SUPABASE_KEY, video_path, filename)
+    return supabase.storage.from_("videos").get_public_url(filename)
+
+async def remove_upload(filename):
+    # Drop a finished upload whose pipeline failed, instead of leaving it orphaned in Storage
+    if not filename:
+        return
     try:
-        with open(video_path, 'rb') as f:
-            supabase.storage.from_("videos").upload(
-                path=filename,
-                file=f,
-                file_options={"content-type": "video/mp4", "x-upsert": "true"}
-            )
-        public_url = supabase.storage.from_("videos").get_public_url(filename)
+        await asyncio.to_thread(supabase.storage.from_("videos").remove, [filename])
     except Exception as e:
-        print(f"❌ Upload Error: {e}")
+        print(f"⚠️ Could not remove orphaned upload {filename}: {e}")
+
+async def discard_upload(upload_task, filename):
+    # Cancelling a to_thread task doesn't stop the upload thread, so let it finish first
+    try:
+        await upload_task
+    except Exception:
         return
+    await remove_upload(filename)
+
+# --- HELPER: THE PIPELINE (REVISED) ---
+async def run_pipeline(url: str):
+    if not url or url == "":
+        print("❌ Received empty URL. Aborting.")
+        return
+
+    print(f"🚀 Pipeline Started for: {url}")
+    
+    # Every intermediate lives in a per-job dir, removed on every exit path (including early returns)
+    with tempfile.TemporaryDirectory(dir=TMPDIR) as work_dir:
+        # 1. Download (audio only, or a 720p MP4 + audio in one pass when we host the video)
+        video_path = None
+        try:
+            if HOST_VIDEOS:
+                video_path, audio_path, source_title, source_id = await asyncio.to_thread(download_and_split, url, work_dir)
+                source_path = video_path
+            else:
+                source_path, source_title = await asyncio.to_thread(download_audio, url, work_dir)
+        except Exception as e:
+            print(f"❌ Download failed: {e}")
+            return
+
+        # 2. Extract Audio (the hosted-video pipe already wrote it)
+        print("🔊 Extracting Audio...")
+        try:
+            duration = await asyncio.to_thread(get_duration, source_path)
+            if duration < 5:
+                print("❌ Video too short (likely a download error/captcha). Aborting.")
+                return
+            if not video_path:
+                # Distinct suffix so an .ogg source is never overwritten in place
+                audio_path = os.path.splitext(source_path)[0] + ".16k.ogg"
+                await asyncio.to_thread(extract_audio, source_path, audio_path)
+        except Exception as e:
+            print(f"❌ Audio Error: {e}")
+            return
+
+        # 3. Transcribe + Upload Video
+        # Both are network-bound, so run them side by side instead of back to back.
+        print("🎙️ Transcribing & ☁️ Uploading...")
+        transcript_task = asyncio.create_task(transcribe(audio_path))
+        filename = None
+        if video_path:
+            # Source title + id, since the AI title isn't known yet
+            filename = storage_filename(source_title, source_id)
+            upload_task = asyncio.create_task(asyncio.to_thread(publish_video, video_path, filename))
+        else:
+            # Not hosting: play back straight from the source URL
+            upload_task = asyncio.create_task(asyncio.sleep(0, result=url))
+
+        try:
+            transcript_text = await transcript_task
+        except Exception as e:
+            print(f"❌ Transcription Error: {e}")
+            await discard_upload(upload_task, filename)
+            return
+
+        if len(transcript_text) < 20:
+            print(f"❌ Transcript too short ('{transcript_text}'). Aborting.")
+            await discard_upload(upload_task, filename)
+            return
 
-    # 6. Save DB
-    print("💾 Saving to DB...")
+        # 4. AI Analysis (overlaps with the tail of the upload)
+        print("🧠 AI Analyzing...")
     
-    # PURE DATA: No merging.
-    # We trust the DB columns to hold separate values.
-    category_val = meta.get('category', 'General')
-    sub_cat_val = meta.get('sub_category', None) # Default to None/Null if empty
+        # The schema is enforced by structured outputs, so the prompt only carries the task
+        prompt = f"""
+        Analyze this transcript. Fill in the video metadata and write multiple choice questions
+        (stage 0 = easiest) with one correct answer and three wrong options each.
+
+        TRANSCRIPT: {truncate_transcript(transcript_text)}
+        """
+
+        try:
+            response = await asyncio.to_thread(analyze, prompt)
+            analysis = response.choices[0].message.parsed
+            if analysis is None:
+                raise ValueError(f"Model refused: {response.choices[0].message.refusal}")
+            meta = analysis.metadata
+            questions = analysis.questions
+
+        except Exception as e:
+            print(f"❌ AI Error: {e}")
+            await discard_upload(upload_task, filename)
+            return
+
+        # 5. Finish Upload
+        try:
+            public_url = await upload_task
+        except Exception as e:
+            print(f"❌ Upload Error: {e}")
+            return
+
+        # 6. Save DB
+        print("💾 Saving to DB...")
     
-    vid_data = {
-        "video_url": public_url,
-        "title": meta.get('title', 'Untitled'),
-        "transcript_text": transcript_text,
-        "category": category_val,       # e.g. "Psychology"
-        "sub_category": sub_cat_val,    # e.g. "Media Consumption"
-        "duration_seconds": int(duration)
-    }
+        # PURE DATA: No merging.
+        # We trust the DB columns to hold separate values.
+        category_val = meta.category or 'General'
+        sub_cat_val = meta.sub_category or None # Default to None/Null if empty
     
-    try:
-        res = supabase.table("content_library").insert(vid_data).execute()
-        new_id = res.data[0]['id']
-        
-        # 7. Insert Questions
-        if questions:
-            q_inserts = []
-            for q in questions:
-                q_inserts.append({
-                    "video_id": new_id,
-                    "difficulty_phase": q.get('stage', 0),
-                    "question_text": q.get('q', 'Error'),
-                    "correct_answer": q.get('correct', 'Error'),
-                    "wrong_options": q.get('wrong', [])
-                })
-            supabase.table("questions").insert(q_inserts).execute()
-            print(f"✅ Success! Saved {len(q_inserts)} questions.")
-        else:
-            print("⚠️ Warning: AI returned 0 questions (Check transcript length).")
+        vid_data = {
+            "video_url": public_url,
+            "title": meta.title or 'Untitled',
+            "transcript_text": transcript_text,
+            "category": category_val,       # e.g. "Psychology"
+            "sub_category": sub_cat_val,    # e.g. "Media Consumption"
+            "duration_seconds": int(duration)
+        }
+    
+        # 7. Questions ride along in the same RPC call (one round-trip, one transaction)
+        q_inserts = []
+        for q in questions:
+            q_inserts.append({
+                "difficulty_phase": q.stage,
+                "question_text": q.q,
+                "correct_answer": q.correct,
+                "wrong_options": q.wrong
+            })
+
+        try:
+            await asyncio.to_thread(
+                supabase.rpc("create_video_with_questions", {"vid_data": vid_data, "q_data": q_inserts}).execute
+            )
+            if q_inserts:
+                print(f"✅ Success! Saved {len(q_inserts)} questions.")
+            else:
+                print("⚠️ Warning: AI returned 0 questions (Check transcript length).")
             
-    except Exception as e:
-        print(f"❌ Database Save Error: {e}")
+        except Exception as e:
+            print(f"❌ Database Save Error: {e}")
+            await remove_upload(filename)
+            return
 
-    # Cleanup
-    if os.path.exists(video_path): os.remove(video_path)
-    if os.path.exists(audio_path): os.remove(audio_path)
-    print("✅ PIPELINE COMPLETE")
+        print("✅ PIPELINE COMPLETE")
+
+# --- WORKER ENTRYPOINT ---
+def process_url(url: str):
+    # RQ jobs are plain functions, so drive the async pipeline to completion here
+    asyncio.run(run_pipeline(url))
 
 # --- ENDPOINT ---
 @app.post("/capture")
 async def capture_video(request: VideoRequest, background_tasks: BackgroundTasks):
+    if queue:
+        job = queue.enqueue(process_url, request.url, job_timeout=3600)
+        return {"status": "processing", "job_id": job.id, "message": "Fluency is curating this video..."}
+
     background_tasks.add_task(run_pipeline, request.url)
     return {"status": "processing", "message": "Fluency is curating this video..."}
 
@@ -0,0 +1,111 @@
+import os
+import re
+import functools
+import shutil
+import subprocess
+import tempfile
+import httpx
+import tiktoken
+from pydantic import BaseModel
+
+# Helpers shared by admin.py (Streamlit uploads) and api.py (URL capture).
+# Keep this module free of secrets/clients: callers pass those in.
+
+# --- TEMP FILES ---
+# Keep intermediates on tmpfs (RAM) when it has room; Docker's default 64MB /dev/shm does not
+def pick_tmpdir(min_free=2 * 1024**3):
+    if os.path.isdir("/dev/shm") and shutil.disk_usage("/dev/shm").free >= min_free:
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+TMPDIR = pick_tmpdir()
+
+# Anything outside this set is stripped from storage filenames
+_SAFE_RE = re.compile(r'[^A-Za-z0-9 _-]')
+
+def storage_filename(title, unique):
+    # Storage uploads upsert, so the unique part keeps videos with the same title
+    # (or titles stripped to nothing, e.g. non-Latin ones) from overwriting each other
+    safe_title = _SAFE_RE.sub('', title).replace(' ', '_') or 'Video'
+    return f"{safe_title}_{_SAFE_RE.sub('', unique)}.mp4"
+
+# --- AUDIO ---
+@functools.cache
+def has_cuda():
+    # Opens a real CUDA device: an NVENC-capable ffmpeg build alone doesn't mean a GPU is present.
+    # Cached, so this runs once per process (Streamlit reruns included).
+    try:
+        probe = subprocess.run(
+            ["ffmpeg", "-v", "error", "-init_hw_device", "cuda", "-f", "lavfi", "-i", "anullsrc", "-t", "0", "-f", "null", "-"],
+            capture_output=True
+        )
+    except OSError:
+        return False
+    return probe.returncode == 0
+
+# Normalize first so quiet speakers are lifted above the silence threshold, then shorten
+# pauses over 0.5s to ~0.7s: silenceremove keeps stop_duration plus stop_silence of each one
+# (fewer minutes to transcribe, but sentences stay separated).
+# Tuned against ffmpeg 7.0.2 (the nixpkgs `ffmpeg` nixpacks installs). silenceremove's options
+# changed meaning in ffmpeg 6.1, and there the default rms detector trims nothing from pure
+# digital silence unless loudnorm runs first, so re-measure pause lengths after any ffmpeg bump.
+AUDIO_FILTERS = (
+    "loudnorm=I=-16:LRA=11:TP=-1.5,"
+    "silenceremove=stop_periods=-1:stop_duration=0.5:stop_threshold=-40dB:stop_silence=0.2"
+)
+# 16kHz mono Opus: Whisper downsamples to this anyway, and it keeps uploads tiny
+AUDIO_ENCODE = ["-c:a", "libopus", "-b:a", "24k", "-ac", "1", "-ar", "16000"]
+
+def get_duration(path):
+    # Reads container metadata only, no decoding
+    return float(subprocess.check_output([
+        "ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path
+    ]))
+
+def extract_audio(video_path, out_path):
+    # Hardware decode only applies once a video decoder is opened; with -vn it is a no-op today,
+    # but keeps the flags in place for any future video transcode step.
+    hwaccel = ["-hwaccel", "cuda"] if has_cuda() else ["-hwaccel", "auto"]
+    subprocess.run([
+        "ffmpeg", "-y", "-v", "error",
+        *hwaccel, "-i", video_path,
+        "-vn", "-af", AUDIO_FILTERS, *AUDIO_ENCODE,
+        out_path
+    ], check=True)
+
+# --- STORAGE ---
+# Bounded so a stalled Storage connection fails the job instead of hanging it.
+# The write timeout applies per chunk, so large streamed uploads are fine.
+STORAGE_TIMEOUT = httpx.Timeout(60, connect=10)
+
+def upload_video(http, supabase_url, supabase_key, video_path, filename):
+    # Passing the file handle lets httpx stream it in chunks instead of reading the whole MP4 into RAM
+    with open(video_path, 'rb') as f:
+        r = http.post(
+            f"{supabase_url}/storage/v1/object/videos/{filename}",
+            headers={
+                "Authorization": f"Bearer {supabase_key}",
+                "apikey": supabase_key,
+                "Content-Type": "video/mp4",
+                "x-upsert": "true"
+            },
+            content=f
+        )
+    r.raise_for_status()
+
+# --- PROMPT ---
+# GPT-4o tokenizer, loaded once per process
+enc = tiktoken.get_encoding("o200k_base")
+TRANSCRIPT_TOKEN_BUDGET = 8000
+
+def truncate_transcript(text):
+    # Cut to a fixed token budget (not characters) so prompt size is predictable in any language
+    tokens = enc.encode(text, disallowed_special=())
+    return enc.decode(tokens[:TRANSCRIPT_TOKEN_BUDGET])
+
+# --- AI OUTPUT MODEL (enforced via structured outputs) ---
+class Question(BaseModel):
+    stage: int
+    q: str
+    correct: str
+    wrong: list[str]
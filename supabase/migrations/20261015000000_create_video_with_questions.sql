@@ -0,0 +1,21 @@
+-- Inserts a content_library row and its questions in one round-trip and one transaction.
+-- Called from api.py / admin.py via supabase.rpc("create_video_with_questions", {"vid_data": ..., "q_data": [...]}).
+create or replace function create_video_with_questions(vid_data jsonb, q_data jsonb)
+returns content_library.id%type
+language plpgsql
+as $$
+declare
+  new_id content_library.id%type;
+begin
+  insert into content_library (video_url, title, transcript_text, category, sub_category, duration_seconds)
+  select r.video_url, r.title, r.transcript_text, r.category, r.sub_category, r.duration_seconds
+  from jsonb_populate_record(null::content_library, vid_data) r
+  returning id into new_id;
+
+  insert into questions (video_id, difficulty_phase, question_text, correct_answer, wrong_options)
+  select new_id, r.difficulty_phase, r.question_text, r.correct_answer, r.wrong_options
+  from jsonb_populate_recordset(null::questions, coalesce(q_data, '[]'::jsonb)) r;
+
+  return new_id;
+end;
+$$;